@@ -6,20 +6,538 @@ st.set_page_config(page_title="AI Legal Team Agents", page_icon="⚖️", layout
 
 # Now import the rest
 import os
-import tempfile
+import asyncio
+import hashlib
+import json
+import math
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from hashlib import md5
+from io import BytesIO
+from pathlib import Path
 from agno.agent import Agent
 from agno.models.google import Gemini
 from agno.embedder.google import GeminiEmbedder
 from agno.tools.duckduckgo import DuckDuckGoTools
-from agno.knowledge.pdf import PDFKnowledgeBase, PDFReader
+from agno.knowledge.agent import AgentKnowledge
+from agno.knowledge.pdf import PDFReader
 from agno.vectordb.chroma import ChromaDb
+from agno.utils.log import logger
+from duckduckgo_search import DDGS
+from pydantic import BaseModel, Field
 import sqlite3
+import fitz
 
 # Ensure the SQLite version is printed (debugging)
 #st.write(f"SQLite version: {sqlite3.sqlite_version}")
 
+from agno.document.base import Document
 from agno.document.chunking.document import DocumentChunking
 
+def get_setting(key, default):
+    """Read an optional tuning setting from st.secrets, falling back to `default` when no secrets file exists."""
+    # st.secrets.get() renders an error box when there is no secrets.toml, even though the exception is caught
+    if not st.secrets.load_if_toml_exists():
+        return default
+    return st.secrets.get(key, default)
+
+
+def get_flag(key, default=False):
+    """Read an on/off setting; accepts TOML booleans as well as strings such as "true" or "false"."""
+    value = get_setting(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+MODEL_ID = "gemini-2.0-flash-exp"
+CHROMA_PATH = "tmp/chromadb"
+
+# Shared by every specialist prompt, ahead of the query
+SHARED_PREFACE = (
+    "You are a member of an AI legal team reviewing the legal document excerpted below. "
+    "Base your answer on this document context and reference specific sections where possible."
+)
+
+# Filled with the specialists' response text (not the RunResponse objects, whose repr would inflate the prompt)
+TEAM_LEAD_PROMPT = (
+    "Summarize and integrate the following insights gathered using the retrieved document snippets:\n\n"
+    "Legal Researcher:\n{research}\n\n"
+    "Contract Analyst:\n{contract}\n\n"
+    "Legal Strategist:\n{strategy}"
+)
+
+# How often streamed specialist output is redrawn
+STREAM_REFRESH_SECONDS = 0.2
+
+# Upper bound on concurrent DuckDuckGo requests from a single tool call
+SEARCH_WORKERS = 4
+
+# Chunks retrieved per query: MMR picks RETRIEVAL_TOP_K from RETRIEVAL_TOP_K * MMR_FETCH_FACTOR nearest neighbours
+RETRIEVAL_TOP_K = 6
+MMR_FETCH_FACTOR = 4
+MMR_LAMBDA = 0.5
+
+# Vector index parameters, fixed when a collection is created
+HNSW_CONFIG = {"hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 64}
+
+# Documents remembered per session; beyond this the least recently used one's collection is deleted
+MAX_CACHED_DOCUMENTS = 32
+
+# Chroma recommends writing 50-250 records per call; one call per chunk pays a SQLite transaction each time
+CHROMA_BATCH_SIZE = int(get_setting("CHROMA_BATCH_SIZE", 200))
+
+# Gemini accepts up to 100 texts per embed_content request
+EMBED_BATCH_SIZE = 96
+
+# Stored vector size. Gemini embeddings can be truncated (3072, 1536 or 768); 768 halves Chroma's memory and disk use.
+EMBED_DIMENSIONS = int(get_setting("EMBED_DIMENSIONS", 1536))
+
+# Opt-in only: every stored document shares tmp/chromadb/chroma.sqlite3 and is reused across uploads and sessions,
+# so with synchronous=OFF a crash or power loss can corrupt all of them. journal_mode=WAL is persistent and stays on
+# the database file after the flag is turned off.
+# locking_mode=EXCLUSIVE is left out: Chroma opens one connection per thread and it would lock the others out.
+CHROMA_UNSAFE_FAST = get_flag("CHROMA_UNSAFE_FAST")
+SQLITE_FAST_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Queries whose embeddings are at least this similar are answered from the same cache entry
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_SIZE = 128
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def mmr_select(query_embedding, embeddings, k, lambda_mult=MMR_LAMBDA):
+    """Return the indices of `k` embeddings chosen by Maximal Marginal Relevance."""
+    relevance = [cosine_similarity(query_embedding, embedding) for embedding in embeddings]
+    selected = []
+    candidates = list(range(len(embeddings)))
+    while candidates and len(selected) < k:
+        best = max(
+            candidates,
+            key=lambda i: lambda_mult * relevance[i] - (1 - lambda_mult) * max(
+                (cosine_similarity(embeddings[i], embeddings[j]) for j in selected), default=0.0
+            ),
+        )
+        selected.append(best)
+        candidates.remove(best)
+    return selected
+
+
+def resolve_cached_query(doc_key, query):
+    """Return an earlier query for this document that is semantically equivalent to `query`, or `query` itself."""
+    try:
+        embedding = GeminiEmbedder().get_embedding(query)
+    except Exception:
+        return query
+    if not embedding:
+        return query
+
+    for cached_key, cached_embedding, cached_query in st.session_state.semantic_cache:
+        if cached_key == doc_key and cosine_similarity(embedding, cached_embedding) >= SEMANTIC_CACHE_THRESHOLD:
+            return cached_query
+
+    st.session_state.semantic_cache.append((doc_key, embedding, query))
+    del st.session_state.semantic_cache[:-SEMANTIC_CACHE_SIZE]
+    return query
+
+
+class TeamReport(BaseModel):
+    """The team lead's response schema; Gemini is constrained to it, so every field arrives as a markdown string."""
+
+    analysis: str = Field(
+        ...,
+        description="A structured legal analysis report in markdown that includes key terms, obligations, risks, "
+        "and recommendations, with references to the document.",
+    )
+    key_points: str = Field(..., description="A markdown summary of the key legal points from this analysis.")
+    recommendations: str = Field(..., description="Specific legal recommendations in markdown based on this analysis.")
+
+
+def parse_team_report(content):
+    """Split the team lead's report into its analysis, key points and recommendations."""
+    if not isinstance(content, TeamReport):
+        try:
+            content = TeamReport.model_validate_json(content)
+        except ValueError:
+            # agno couldn't parse the response into a TeamReport; keep whatever was generated as the analysis
+            return {"analysis": content, "key_points": "", "recommendations": ""}
+    return content.model_dump()
+
+
+class PartialReportError(Exception):
+    """Raised with a report built while some specialists failed, so st.cache_data doesn't keep it."""
+
+    def __init__(self, report, failed):
+        super().__init__(f"No response from: {', '.join(failed)}")
+        self.report = report
+
+
+def retrieve_context(knowledge_base, query):
+    documents = knowledge_base.search(query=query)
+    return "\n\n".join(document.content for document in documents)
+
+
+def build_prompt(query, context):
+    """Build a specialist prompt as [shared preface and document context][query].
+
+    The role instructions are left out; agno already sends them in the agent's system message.
+    """
+    return f"{SHARED_PREFACE}\n\nDocument context:\n{context}\n\nQuery:\n{query}"
+
+
+class PyMuPDFReader(PDFReader):
+    """PDFReader that extracts page text with PyMuPDF, which is much faster than pypdf on long documents."""
+
+    def read(self, pdf):
+        if isinstance(pdf, (str, Path)):
+            doc_name = Path(pdf).stem
+            source = str(pdf)
+        else:
+            doc_name = Path(getattr(pdf, "name", "pdf")).stem
+            source = pdf.read()
+
+        # Extracted in-process: PyMuPDF reads hundreds of pages in tens of milliseconds, less than a worker pool takes to start
+        if isinstance(source, bytes):
+            pdf_doc = fitz.open(stream=source, filetype="pdf")
+        else:
+            pdf_doc = fitz.open(source)
+        with pdf_doc:
+            texts = [page.get_text("text") for page in pdf_doc]
+
+        documents = [
+            Document(
+                name=doc_name,
+                id=f"{doc_name}_{page_number}",
+                meta_data={"page": page_number},
+                content=text,
+            )
+            for page_number, text in enumerate(texts, start=1)
+        ]
+
+        if self.chunk:
+            return [chunk for document in documents for chunk in self.chunk_document(document)]
+        return documents
+
+    async def async_read(self, pdf):
+        return await asyncio.to_thread(self.read, pdf)
+
+
+def embed_texts(embedder, texts, batch_size=EMBED_BATCH_SIZE):
+    """Embed `texts` with one Gemini request per batch rather than one request per text."""
+    if not isinstance(embedder, GeminiEmbedder):
+        return [embedder.get_embedding(text) for text in texts]
+
+    config = {}
+    if embedder.dimensions:
+        config["output_dimensionality"] = embedder.dimensions
+    if embedder.task_type:
+        config["task_type"] = embedder.task_type
+    if embedder.title:
+        config["title"] = embedder.title
+
+    embeddings = []
+    for start in range(0, len(texts), batch_size):
+        response = embedder.client.models.embed_content(
+            model=embedder.id.split("/")[-1],
+            contents=texts[start:start + batch_size],
+            config=config or None,
+        )
+        embeddings.extend(embedding.values for embedding in response.embeddings)
+    return embeddings
+
+
+class PDFBytesKnowledgeBase(AgentKnowledge):
+    """Knowledge base for a PDF held in memory, so uploads never have to be written to disk."""
+
+    data: bytes
+    name: str = "document.pdf"
+    # Stored on every chunk so each one can be traced back to its upload
+    source_id: str = ""
+    reader: PyMuPDFReader = PyMuPDFReader()
+
+    @property
+    def document_lists(self):
+        pdf = BytesIO(self.data)
+        pdf.name = self.name
+        documents = self.reader.read(pdf)
+        for document in documents:
+            document.meta_data["source_id"] = self.source_id
+        yield documents
+
+
+class BatchedChromaDb(ChromaDb):
+    """ChromaDb that writes documents to the collection in batches of `batch_size`."""
+
+    def __init__(self, *args, batch_size=CHROMA_BATCH_SIZE, progress=None, hnsw_config=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size
+        self.hnsw_config = hnsw_config or HNSW_CONFIG
+        # Optional dict updated with {"stage", "done", "total"} as batches are written
+        self.progress = progress
+
+    def create(self):
+        if self.exists():
+            self._collection = self.client.get_collection(name=self.collection_name)
+        else:
+            self._collection = self.client.create_collection(
+                name=self.collection_name, metadata={"hnsw:space": self.distance.value, **self.hnsw_config}
+            )
+
+    def get_collection(self):
+        if not self._collection:
+            self._collection = self.client.get_collection(name=self.collection_name)
+        return self._collection
+
+    def mark_complete(self):
+        """Record in the collection metadata that every chunk of the document has been written."""
+        collection = self.get_collection()
+        # Chroma rejects any metadata update that names the distance function; the index keeps it regardless
+        metadata = {key: value for key, value in (collection.metadata or {}).items() if key != "hnsw:space"}
+        collection.modify(metadata={**metadata, "ingest_complete": True})
+
+    def is_complete(self):
+        """Whether the collection holds a fully ingested document; an interrupted ingest leaves it unmarked."""
+        return self.exists() and bool((self.get_collection().metadata or {}).get("ingest_complete"))
+
+    def tune_sqlite(self):
+        """Apply SQLITE_FAST_PRAGMAS to the calling thread's connection to Chroma's SQLite store."""
+        try:
+            connection = self.client._server._sysdb._conn_pool.connect()
+            for pragma in SQLITE_FAST_PRAGMAS:
+                connection.execute(pragma)
+        except Exception as e:
+            # Not a local SQLite-backed client, or Chroma's internals changed; writes still work untuned
+            logger.warning(f"CHROMA_UNSAFE_FAST is set but the SQLite pragmas could not be applied: {e}")
+
+    def write(self, write_batch, documents):
+        if CHROMA_UNSAFE_FAST and self.persistent_client:
+            self.tune_sqlite()
+
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start:start + self.batch_size]
+            contents = [document.content.replace("\x00", "\ufffd") for document in batch]
+            ids = [md5(content.encode()).hexdigest() for content in contents]
+            metadatas = [document.meta_data for document in batch]
+            embeddings = embed_texts(self.embedder, contents)
+            write_batch(ids=ids, embeddings=embeddings, documents=contents, metadatas=metadatas)
+            if self.progress is not None:
+                self.progress.update(stage="embedding", done=start + len(batch), total=len(documents))
+
+    def insert(self, documents, filters=None):
+        self.write(self.get_collection().add, documents)
+
+    def search(self, query, limit=5, filters=None):
+        """Return `limit` chunks for `query`, re-ranked with MMR so near-duplicate chunks aren't all sent to the model."""
+        query_embedding = self.embedder.get_embedding(query)
+        if not query_embedding:
+            return []
+
+        result = self.get_collection().query(
+            query_embeddings=[query_embedding],
+            n_results=limit * MMR_FETCH_FACTOR,
+            where=filters,
+            include=["metadatas", "documents", "embeddings", "distances"],
+        )
+        candidates = []
+        for id_, content, metadata, embedding, distance in zip(
+            result["ids"][0], result["documents"][0], result["metadatas"][0], result["embeddings"][0], result["distances"][0]
+        ):
+            embedding = embedding.tolist() if hasattr(embedding, "tolist") else embedding
+            candidates.append(
+                Document(id=id_, content=content, meta_data={**metadata, "distances": distance}, embedding=embedding)
+            )
+
+        selected = mmr_select(query_embedding, [candidate.embedding for candidate in candidates], limit)
+        return [candidates[i] for i in selected]
+
+    def upsert(self, documents, filters=None):
+        self.write(self.get_collection().upsert, documents)
+
+
+class PooledDDGS(DDGS):
+    """DDGS client meant to be shared, so its HTTP connections stay open between searches."""
+
+    def _sleep(self, sleeptime=0.75):
+        # DDGS throttles repeat calls on one instance; a fresh client per search (agno's default) never waited
+        pass
+
+
+@st.cache_resource
+def get_search_client():
+    return PooledDDGS(timeout=10)
+
+
+class PooledDuckDuckGoTools(DuckDuckGoTools):
+    """DuckDuckGoTools backed by one shared search client, with a tool for running several searches at once."""
+
+    def __init__(self, client, **kwargs):
+        super().__init__(**kwargs)
+        self.ddgs = client
+        self.register(self.duckduckgo_search_many)
+
+    def duckduckgo_search(self, query: str, max_results: int = 5) -> str:
+        """Use this function to search DuckDuckGo for a query.
+
+        Args:
+            query(str): The query to search for.
+            max_results (optional, default=5): The maximum number of results to return.
+
+        Returns:
+            The result from DuckDuckGo.
+        """
+        search_query = f"{self.modifier} {query}" if self.modifier else query
+        results = self.ddgs.text(keywords=search_query, max_results=self.fixed_max_results or max_results)
+        return json.dumps(results, indent=2)
+
+    def duckduckgo_news(self, query: str, max_results: int = 5) -> str:
+        """Use this function to get the latest news from DuckDuckGo.
+
+        Args:
+            query(str): The query to search for.
+            max_results (optional, default=5): The maximum number of results to return.
+
+        Returns:
+            The latest news from DuckDuckGo.
+        """
+        results = self.ddgs.news(keywords=query, max_results=self.fixed_max_results or max_results)
+        return json.dumps(results, indent=2)
+
+    def duckduckgo_search_many(self, queries: list[str], max_results: int = 5) -> str:
+        """Use this function to search DuckDuckGo for several queries at once, e.g. one per case or regulation.
+
+        Args:
+            queries(list[str]): The queries to search for.
+            max_results (optional, default=5): The maximum number of results to return per query.
+
+        Returns:
+            A JSON object mapping each query to its results from DuckDuckGo.
+        """
+        if not queries:
+            return json.dumps({})
+        with ThreadPoolExecutor(max_workers=min(len(queries), SEARCH_WORKERS)) as executor:
+            results = executor.map(lambda query: json.loads(self.duckduckgo_search(query, max_results)), queries)
+            return json.dumps(dict(zip(queries, results)), indent=2)
+
+
+def make_vector_db(doc_key, hnsw_config=None):
+    # One collection per document content and chunking, so identical uploads can reuse what is already stored.
+    # Vectors of different sizes can't share a collection, so the size is part of the name.
+    return BatchedChromaDb(
+        collection=f"law_{doc_key}_{EMBED_DIMENSIONS}",
+        path=CHROMA_PATH,
+        persistent_client=True,
+        embedder=GeminiEmbedder(dimensions=EMBED_DIMENSIONS),
+        hnsw_config=hnsw_config,
+    )
+
+
+class CollectionUsers:
+    """Process-wide record of the sessions using each document collection.
+
+    Collections are shared by every session that uploads the same file, so one is only deleted
+    once the last of them lets go of it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def acquire(self, doc_key, session_id):
+        with self.lock:
+            self.users.setdefault(doc_key, set()).add(session_id)
+
+    def release(self, doc_key, session_id):
+        with self.lock:
+            users = self.users.get(doc_key, set())
+            users.discard(session_id)
+            if not users:
+                self.users.pop(doc_key, None)
+                # Deleted under the lock so no session can acquire the collection halfway through.
+                # A failed ingest may never have created it, and agno logs an error for a missing collection.
+                vector_db = make_vector_db(doc_key)
+                if vector_db.exists():
+                    vector_db.delete()
+
+
+@st.cache_resource
+def get_collection_users():
+    return CollectionUsers()
+
+
+def ingest_document(doc_bytes, doc_hash, filename, vector_db, chunk_size, overlap, status):
+    """Parse, embed and store an uploaded PDF. Runs on a background thread and reports through `status`."""
+    try:
+        # Process the uploaded document into knowledge base
+        vector_db.progress = status
+        knowledge_base = PDFBytesKnowledgeBase(
+            data=doc_bytes,
+            name=filename,
+            source_id=doc_hash,
+            vector_db=vector_db,
+            num_documents=RETRIEVAL_TOP_K,
+            reader=PyMuPDFReader(),
+            chunking_strategy=DocumentChunking(chunk_size=chunk_size, overlap=overlap)
+        )
+        # The collection is specific to this document, so an upsert never has to rebuild it
+        knowledge_base.load(recreate=False, upsert=True)
+        vector_db.mark_complete()
+        status.update(stage="done", knowledge_base=knowledge_base)
+    except Exception as e:
+        status.update(stage="error", error=e)
+
+
+def use_document(doc_key, filename, knowledge_base):
+    st.session_state.knowledge_base = knowledge_base
+    st.session_state.doc_key = doc_key
+
+    doc_lru = st.session_state.doc_lru
+    doc_lru[doc_key] = filename
+    doc_lru.move_to_end(doc_key)
+    while len(doc_lru) > MAX_CACHED_DOCUMENTS:
+        evicted_key, _ = doc_lru.popitem(last=False)
+        get_collection_users().release(evicted_key, st.session_state.session_id)
+
+
+def clear_knowledge_base():
+    """Release every document in this session, deleting collections no other session uses, and start over.
+
+    Only offered while no ingest is running, so every collection this session holds is in its LRU.
+    """
+    for doc_key in st.session_state.doc_lru:
+        get_collection_users().release(doc_key, st.session_state.session_id)
+    st.session_state.doc_lru.clear()
+    st.session_state.knowledge_base = None
+    st.session_state.doc_key = None
+    st.session_state.semantic_cache = []
+    st.session_state.last_report = None
+    st.session_state.uploader_key += 1
+
+
+def run_specialist(agent, query, context, on_delta):
+    """Stream a specialist's answer, passing each text delta to `on_delta`, and return the full text."""
+    prompt = build_prompt(query, context)
+
+    chunks = []
+    for chunk in agent.run(prompt, stream=True):
+        if isinstance(chunk.content, str):
+            chunks.append(chunk.content)
+            on_delta(chunk.content)
+    return "".join(chunks)
+
+
 # Initialize Streamlit
 # Customizing the page title and header
 #st.set_page_config(page_title="AI Legal Team Agents", page_icon="⚖️", layout="wide")
@@ -37,16 +555,29 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Initialize session state
-if "vector_db" not in st.session_state:
-    st.session_state.vector_db = ChromaDb(
-        collection="law", path="tmp/chromadb", persistent_client=True, embedder=GeminiEmbedder()
-    )
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 if "knowledge_base" not in st.session_state:
     st.session_state.knowledge_base = None
 
-if "processed_files" not in st.session_state:
-    st.session_state.processed_files = set()
+if "doc_lru" not in st.session_state:
+    st.session_state.doc_lru = OrderedDict()
+
+if "doc_key" not in st.session_state:
+    st.session_state.doc_key = None
+
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = []
+
+if "upload_status" not in st.session_state:
+    st.session_state.upload_status = None
+
+if "uploader_key" not in st.session_state:
+    st.session_state.uploader_key = 0
+
+if "last_report" not in st.session_state:
+    st.session_state.last_report = None
 
 # Sidebar for API Config & File Upload
 with st.sidebar:
@@ -74,61 +605,120 @@ with st.sidebar:
     chunk_size_in = st.sidebar.number_input("Chunk Size", min_value=1, max_value=5000, value=1000)
     overlap_in = st.sidebar.number_input("Overlap", min_value=1, max_value=1000, value=200)
 
+    with st.sidebar.expander("Advanced settings"):
+        st.caption(
+            "Vector index settings are fixed when a document is first processed. "
+            "Re-uploading a document keeps its existing index unless the chunk settings change."
+        )
+        hnsw_config = {
+            "hnsw:M": st.number_input("HNSW M", min_value=4, max_value=64, value=HNSW_CONFIG["hnsw:M"]),
+            "hnsw:construction_ef": st.number_input(
+                "HNSW construction ef", min_value=16, max_value=1000, value=HNSW_CONFIG["hnsw:construction_ef"]
+            ),
+            "hnsw:search_ef": st.number_input(
+                "HNSW search ef", min_value=1, max_value=1000, value=HNSW_CONFIG["hnsw:search_ef"]
+            ),
+        }
+        reuse_similar_queries = st.checkbox(
+            "Reuse reports for similar custom questions",
+            value=False,
+            help="Answers a custom question with the report of an earlier one whose embedding is nearly identical. "
+            "Questions that differ only in a clause number or party can match, so check the question shown.",
+        )
+
     st.header("📄 Document Upload")
 
-    uploaded_file = st.file_uploader("Upload a Legal Document (PDF)", type=["pdf"])
+    uploaded_file = st.file_uploader(
+        "Upload a Legal Document (PDF)", type=["pdf"], key=f"uploader_{st.session_state.uploader_key}"
+    )
     
+    upload_waiting = False
     if uploaded_file:
-        if uploaded_file.name not in st.session_state.processed_files:
-            with st.spinner("Processing document..."):
-                try:
-                    # Save to a temp file
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-                        temp_file.write(uploaded_file.getvalue())
-                        temp_path = temp_file.name
-                    
-                    # Process the uploaded document into knowledge base
-                    st.session_state.knowledge_base = PDFKnowledgeBase(
-                        path=temp_path,
-                        vector_db=st.session_state.vector_db,
-                        reader=PDFReader(),
-                        chunking_strategy=DocumentChunking(chunk_size=chunk_size_in, overlap=overlap_in)
-                    )
-
-                    st.session_state.knowledge_base.load(recreate=True, upsert=True)
-                    st.session_state.processed_files.add(uploaded_file.name)
-
+        doc_bytes = uploaded_file.getvalue()
+        doc_hash = hashlib.blake2b(doc_bytes, digest_size=16).hexdigest()
+        # Chunking changes what gets stored, so each setting needs its own collection
+        doc_key = f"{doc_hash}_{chunk_size_in}_{overlap_in}"
+
+        upload_status = st.session_state.upload_status
+        ingesting = upload_status is not None and upload_status["doc_key"] == doc_key
+
+        if doc_key != st.session_state.doc_key and not ingesting:
+            if upload_status is not None:
+                # One ingest at a time, so every finished collection is tracked; this file is picked up afterwards
+                upload_waiting = True
+                st.info(f"{uploaded_file.name} will be processed once {upload_status['filename']} is done.")
+            else:
+                # Claimed before anything is read, so another session can't delete the collection in between
+                get_collection_users().acquire(doc_key, st.session_state.session_id)
+                vector_db = make_vector_db(doc_key, hnsw_config)
+
+                if vector_db.is_complete():
+                    # Same bytes and chunking were processed before, so skip parsing and embedding entirely
+                    knowledge_base = AgentKnowledge(vector_db=vector_db, num_documents=RETRIEVAL_TOP_K)
+                    use_document(doc_key, uploaded_file.name, knowledge_base)
                     st.success("✅ Document processed and stored in knowledge base!")
+                else:
+                    # Ingest in the background so the page stays usable; progress is polled below
+                    st.session_state.upload_status = {
+                        "doc_key": doc_key, "filename": uploaded_file.name, "stage": "parsing", "done": 0, "total": 0
+                    }
+                    threading.Thread(
+                        target=ingest_document,
+                        args=(doc_bytes, doc_hash, uploaded_file.name, vector_db, chunk_size_in, overlap_in, st.session_state.upload_status),
+                        daemon=True,
+                    ).start()
+
+    upload_status = st.session_state.upload_status
+    if upload_status:
+        if upload_status["stage"] == "done":
+            use_document(upload_status["doc_key"], upload_status["filename"], upload_status["knowledge_base"])
+            st.session_state.upload_status = None
+            st.success("✅ Document processed and stored in knowledge base!")
+        elif upload_status["stage"] == "error":
+            st.session_state.upload_status = None
+            if upload_status["doc_key"] not in st.session_state.doc_lru:
+                get_collection_users().release(upload_status["doc_key"], st.session_state.session_id)
+            st.error(f"Error processing document: {upload_status['error']}")
+        elif upload_status["total"]:
+            st.progress(
+                upload_status["done"] / upload_status["total"],
+                text=f"Embedding chunks {upload_status['done']}/{upload_status['total']}...",
+            )
+        else:
+            st.progress(0.0, text="Processing document...")
+
+    # Drawn after the ingest status is handled, so it is enabled again as soon as an ingest finishes
+    st.button(
+        "Clear knowledge base",
+        on_click=clear_knowledge_base,
+        # The running ingest still writes to its collection and reports back through upload_status
+        disabled=st.session_state.upload_status is not None,
+        help="Available once the current document has finished processing.",
+    )
 
-                except Exception as e:
-                    st.error(f"Error processing document: {e}")
-                    
-# Initialize AI Agents (After Document Upload)
-if st.session_state.knowledge_base:
+
+def create_agents():
+    """Create the three specialist agents and the team lead."""
     legal_researcher = Agent(
         name="LegalAdvisor",
-        model=Gemini(id="gemini-2.0-flash-exp"),
-        knowledge=st.session_state.knowledge_base,
-        search_knowledge=True,
-        description="Legal Researcher AI - Finds and cites relevant legal cases, regulations, and precedents using all data in the knowledge base.",
+        model=Gemini(id=MODEL_ID),
+        description="Legal Researcher AI - Finds and cites relevant legal cases, regulations, and precedents using the retrieved document snippets.",
         instructions=[
-        "Extract all available data from the knowledge base and search for legal cases, regulations, and citations.",
-        "If needed, use DuckDuckGo for additional legal references.",
+        "Use the retrieved document snippets provided and search for legal cases, regulations, and citations.",
+        "If needed, use DuckDuckGo for additional legal references, searching for several references at once where possible.",
         "Always provide source references in your answers."
         ],  
-        tools=[DuckDuckGoTools()],
+        tools=[PooledDuckDuckGoTools(get_search_client())],
         show_tool_calls=True,
         markdown=True
     )
 
     contract_analyst = Agent(
         name="ContractAnalyst",
-        model=Gemini(id="gemini-2.0-flash-exp"),
-        knowledge=st.session_state.knowledge_base,
-        search_knowledge=True,
-        description="Contract Analyst AI - Reviews contracts and identifies key clauses, risks, and obligations using the full document data.",
+        model=Gemini(id=MODEL_ID),
+        description="Contract Analyst AI - Reviews contracts and identifies key clauses, risks, and obligations using the retrieved document snippets.",
         instructions=[
-            "Extract all available data from the knowledge base and analyze the contract for key clauses, obligations, and potential ambiguities.",
+            "Use the retrieved document snippets provided to analyze the contract for key clauses, obligations, and potential ambiguities.",
             "Reference specific sections of the contract where possible."
         ],
         show_tool_calls=True,
@@ -137,12 +727,10 @@ if st.session_state.knowledge_base:
 
     legal_strategist = Agent(
         name="LegalStrategist",
-        model=Gemini(id="gemini-2.0-flash-exp"),
-        knowledge=st.session_state.knowledge_base,
-        search_knowledge=True,
-        description="Legal Strategist AI - Provides comprehensive risk assessment and strategic recommendations based on all the available data from the contract.",
+        model=Gemini(id=MODEL_ID),
+        description="Legal Strategist AI - Provides comprehensive risk assessment and strategic recommendations based on the retrieved snippets from the contract.",
         instructions=[
-            "Using all data from the knowledge base, assess the contract for legal risks and opportunities.",
+            "Using the retrieved document snippets provided, assess the contract for legal risks and opportunities.",
             "Provide actionable recommendations and ensure compliance with applicable laws."
         ],
         show_tool_calls=True,
@@ -151,29 +739,114 @@ if st.session_state.knowledge_base:
 
     team_lead = Agent(
         name="teamlead",
-        model=Gemini(id="gemini-2.0-flash-exp"),
+        model=Gemini(id=MODEL_ID),
         description="Team Lead AI - Integrates responses from the Legal Researcher, Contract Analyst, and Legal Strategist into a comprehensive report.",
         instructions=[
             "Combine and summarize all insights provided by the Legal Researcher, Contract Analyst, and Legal Strategist. "
             "Ensure the final report includes references to all relevant sections from the document."
         ],
+        # Sets Gemini's response_schema, so the report always has three string fields
+        response_model=TeamReport,
         show_tool_calls=True,
         markdown=True
     )
 
-    def get_team_response(query):
-        research_response = legal_researcher.run(query)
-        contract_response = contract_analyst.run(query)
-        strategy_response = legal_strategist.run(query)
-
-        final_response = team_lead.run(
-        f"Summarize and integrate the following insights gathered using the full contract data:\n\n"
-        f"Legal Researcher:\n{research_response}\n\n"
-        f"Contract Analyst:\n{contract_response}\n\n"
-        f"Legal Strategist:\n{strategy_response}\n\n"
-        "Provide a structured legal analysis report that includes key terms, obligations, risks, and recommendations, with references to the document."
+    return legal_researcher, contract_analyst, legal_strategist, team_lead
+
+
+@st.cache_resource
+def get_predefined_queries():
+    return {
+        "Contract Review": (
+            "Analyze this document, contract, or agreement using the retrieved document snippets. "
+            "Identify key terms, obligations, and risks in detail."
+        ),
+        "Legal Research": (
+            "Using the retrieved document snippets, find relevant legal cases and precedents related to this document, contract, or agreement. "
+            "Provide detailed references and sources."
+        ),
+        "Risk Assessment": (
+            "Using the retrieved document snippets, identify potential legal risks in this document, contract, or agreement. "
+            "Detail specific risk areas and reference sections of the text."
+        ),
+        "Compliance Check": (
+            "Evaluate this document, contract, or agreement for compliance with legal regulations using the retrieved document snippets. "
+            "Highlight any areas of concern and suggest corrective actions."
         )
-        return final_response
+    }
+
+
+# Initialize AI Agents (After Document Upload)
+if st.session_state.knowledge_base:
+    # Agents keep per-run state, so they are built once per session rather than on every rerun.
+    # Gemini keeps the client it creates on first use, so a new API key needs new agents.
+    if st.session_state.get("agents_api_key") != api_key or "agents" not in st.session_state:
+        st.session_state.agents = create_agents()
+        st.session_state.agents_api_key = api_key
+        # The knowledge base's embedder caches its client the same way
+        embedder = st.session_state.knowledge_base.vector_db.embedder
+        embedder.api_key = embedder.gemini_client = None
+    legal_researcher, contract_analyst, legal_strategist, team_lead = st.session_state.agents
+
+    def get_team_response(query):
+        # Retrieve once and share the same document prefix across all three specialists
+        context = retrieve_context(st.session_state.knowledge_base, query)
+
+        # The three specialists are independent and network-bound, so run them concurrently
+        specialists = {
+            "research": legal_researcher,
+            "contract": contract_analyst,
+            "strategy": legal_strategist,
+        }
+        placeholders = {}
+        for column, (key, agent) in zip(st.columns(len(specialists)), specialists.items()):
+            column.markdown(f"**{agent.name}**")
+            placeholders[key] = column.empty()
+
+        # Worker threads can't draw to the page, so their deltas are queued and rendered here
+        deltas = queue.Queue()
+        streamed = {key: [] for key in specialists}
+        with ThreadPoolExecutor(max_workers=len(specialists)) as executor:
+            futures = {
+                key: executor.submit(
+                    run_specialist, agent, query, context, lambda text, key=key: deltas.put((key, text))
+                )
+                for key, agent in specialists.items()
+            }
+
+            pending = set(futures.values())
+            while pending:
+                _, pending = wait(pending, timeout=STREAM_REFRESH_SECONDS)
+                changed = set()
+                while not deltas.empty():
+                    key, text = deltas.get_nowait()
+                    streamed[key].append(text)
+                    changed.add(key)
+                for key in changed:
+                    placeholders[key].markdown("".join(streamed[key]))
+
+        # A single failing agent is reported to the team lead instead of aborting the analysis
+        responses = {}
+        failed = []
+        for key, future in futures.items():
+            try:
+                responses[key] = future.result()
+            except Exception as e:
+                responses[key] = f"(No response: {e})"
+                failed.append(specialists[key].name)
+            placeholders[key].markdown(responses[key])
+
+        final_response = team_lead.run(TEAM_LEAD_PROMPT.format(**responses))
+        report = parse_team_report(final_response.content or "")
+        if failed:
+            # Often a transient error such as a rate limit, so the next run should try again
+            raise PartialReportError(report, failed)
+        return report
+
+    # Cached on (document key, query) so repeated analyses skip the LLM calls entirely
+    @st.cache_data(show_spinner=False, max_entries=128)
+    def get_cached_report(doc_key, query):
+        return get_team_response(query)
 
 # Analysis Options
 if st.session_state.knowledge_base:
@@ -187,24 +860,7 @@ if st.session_state.knowledge_base:
     if analysis_type == "Custom Query":
         query = st.text_area("Enter your custom legal question:")
     else:
-        predefined_queries = {
-            "Contract Review": (
-                "Analyze this document, contract, or agreement using all available data from the knowledge base. "
-                "Identify key terms, obligations, and risks in detail."
-            ),
-            "Legal Research": (
-                "Using all available data from the knowledge base, find relevant legal cases and precedents related to this document, contract, or agreement. "
-                "Provide detailed references and sources."
-            ),
-            "Risk Assessment": (
-                "Extract all data from the knowledge base and identify potential legal risks in this document, contract, or agreement. "
-                "Detail specific risk areas and reference sections of the text."
-            ),
-            "Compliance Check": (
-                "Evaluate this document, contract, or agreement for compliance with legal regulations using all available data from the knowledge base. "
-                "Highlight any areas of concern and suggest corrective actions."
-            )
-        }
+        predefined_queries = get_predefined_queries()
         query = predefined_queries[analysis_type]
 
     if st.button("Analyze"):
@@ -212,25 +868,48 @@ if st.session_state.knowledge_base:
             st.warning("Please enter a query.")
         else:
             with st.spinner("Analyzing..."):
-                response = get_team_response(query)
-
-                # Display results using Tabs
-                tabs = st.tabs(["Analysis", "Key Points", "Recommendations"])
-
-                with tabs[0]:
-                    st.subheader("📑 Detailed Analysis")
-                    st.markdown(response.content if response.content else "No response generated.")
-
-                with tabs[1]:
-                    st.subheader("📌 Key Points Summary")
-                    key_points_response = team_lead.run(
-                        f"Summarize the key legal points from this analysis:\n{response.content}"
-                    )
-                    st.markdown(key_points_response.content if key_points_response.content else "No summary generated.")
-
-                with tabs[2]:
-                    st.subheader("📋 Recommendations")
-                    recommendations_response = team_lead.run(
-                        f"Provide specific legal recommendations based on this analysis:\n{response.content}"
-                    )
-                    st.markdown(recommendations_response.content if recommendations_response.content else "No recommendations generated.")
+                doc_key = st.session_state.doc_key
+                note = None
+                if analysis_type == "Custom Query" and reuse_similar_queries:
+                    cached_query = resolve_cached_query(doc_key, query)
+                    if cached_query != query:
+                        note = f"Showing the report for an earlier, similar question: {cached_query}"
+                        query = cached_query
+
+                warning = None
+                try:
+                    report = get_cached_report(doc_key, query)
+                except PartialReportError as e:
+                    report = e.report
+                    warning = f"{e} The report below is incomplete and was not cached."
+
+                # Kept in session state so the results survive the reruns that poll a background ingest
+                st.session_state.last_report = {"doc_key": doc_key, "report": report, "warning": warning, "note": note}
+
+    last_report = st.session_state.last_report
+    if last_report and last_report["doc_key"] == st.session_state.doc_key:
+        report = last_report["report"]
+        if last_report["note"]:
+            st.info(last_report["note"])
+        if last_report["warning"]:
+            st.warning(last_report["warning"])
+
+        # Display results using Tabs
+        tabs = st.tabs(["Analysis", "Key Points", "Recommendations"])
+
+        with tabs[0]:
+            st.subheader("📑 Detailed Analysis")
+            st.markdown(report["analysis"] if report["analysis"] else "No response generated.")
+
+        with tabs[1]:
+            st.subheader("📌 Key Points Summary")
+            st.markdown(report["key_points"] if report["key_points"] else "No summary generated.")
+
+        with tabs[2]:
+            st.subheader("📋 Recommendations")
+            st.markdown(report["recommendations"] if report["recommendations"] else "No recommendations generated.")
+
+# Poll the background ingest, and start a waiting upload once it has finished
+if st.session_state.upload_status or upload_waiting:
+    time.sleep(0.5)
+    st.rerun()